@@ -1,49 +1,403 @@
 import os
-import json
-import requests
+import time
+import asyncio
+import logging
+import functools
+import ijson
+import msgspec
+import aiohttp
 from datetime import datetime
+from functools import lru_cache
+from threading import Lock, Thread
+from collections import defaultdict
+from contextvars import ContextVar
+from cachetools import TTLCache
 from langchain_core.tools import tool
 
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+# Connection settings, resolved once at import
+ZABBIX_API_URL = os.getenv('ZABBIX_API_URL')
+ZABBIX_API_TOKEN = os.getenv('ZABBIX_API_TOKEN')
+# Maximum response length in bytes, applies to all tools
+MAX_RESPONSE_LENGTH = int(os.getenv('MAX_RESPONSE_LENGTH', '4096'))
 
-# TODO Set max response length
 headers_dict = {
-    'Content-Type': 'application/json-rpc'
+    'Content-Type': 'application/json-rpc',
+    'Accept-Encoding': 'gzip, br' if brotli is not None else 'gzip',
 }
+if cbor2 is not None:
+    # Prefer CBOR where a proxy can serve it, Zabbix itself answers with JSON
+    headers_dict['Accept'] = 'application/cbor, application/json;q=0.9'
+# Default maximum number of returned objects
+result_limit = 200
+# Uncompressed history responses larger than this are parsed while streaming
+history_stream_threshold = 256 * 1024
+
+# Cache for slowly changing list responses
+_cache = TTLCache(maxsize=256, ttl=60)
+_cache_lock = Lock()
+
+# Cache for resolved item ids and history types
+_item_lookup_cache = TTLCache(maxsize=1024, ttl=300)
+
+# Short lived cache for items that were not found, stops repeated retries
+_not_found_cache = TTLCache(maxsize=1024, ttl=30)
+NOT_FOUND = object()
+not_monitored_message = "The requested item is not monitored on the selected host."
+history_prefix = "Here is the requested item history:\n"
+history_header = 'clock | value'
+
+# Per tool metrics, cache counters of a call are collected in a context variable
+_tool_metrics = defaultdict(lambda: {'calls': 0, 'failures': 0, 'seconds': 0.0, 'characters': 0, 'cache_hits': 0, 'cache_misses': 0})
+_metrics_lock = Lock()
+_call_metrics: ContextVar[dict | None] = ContextVar('call_metrics', default=None)
+
+# Shared HTTP session, reuses connections across tool calls on the same event loop
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+
+# Event loop for synchronous tool calls, runs in a background thread
+_sync_loop: asyncio.AbstractEventLoop | None = None
+_sync_loop_lock = Lock()
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        # A session only works on the event loop it was created on, e.g. each asyncio.run starts a new one
+        _release_session()
+        connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+
+def _release_session() -> None:
+    # Close a session that belongs to another event loop, or drop it if that loop is gone
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        if _session_loop.is_closed():
+            # Its connections went down with the loop
+            _session.detach()
+        else:
+            asyncio.run_coroutine_threadsafe(_session.close(), _session_loop)
+    _session = None
+    _session_loop = None
+
+
+async def close_session() -> None:
+    global _session, _session_loop
+    if _session is not None and not _session.closed and _session_loop is asyncio.get_running_loop():
+        await _session.close()
+        _session = None
+        _session_loop = None
+    else:
+        _release_session()
+
+
+def _run_sync(coroutine):
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            Thread(target=_sync_loop.run_forever, name='zabbix-tools', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _sync_loop).result()
+
+
+def _sync_function(coroutine_function):
+    # Synchronous counterpart of a tool, used by invoke while ainvoke awaits the coroutine
+    @functools.wraps(coroutine_function)
+    def wrapper(*args, **kwargs):
+        return _run_sync(coroutine_function(*args, **kwargs))
+
+    return wrapper
+
+
+def _request_body(method: str, params: dict) -> dict:
+    return {
+        'jsonrpc': '2.0',
+        'method': method,
+        'params': params,
+        'id': 1,
+        'auth': ZABBIX_API_TOKEN
+    }
+
+
+# Constant request bodies, serialized once
+_host_list_body = msgspec.json.encode(_request_body('host.get', {
+    'output': ['host', 'status'],
+    'limit': result_limit,
+}))
+
+
+# History points share minutes, so format each minute only once
+@lru_cache(maxsize=4096)
+def _format_minute(minute: int) -> str:
+    return datetime.fromtimestamp(minute * 60).strftime('%d. %B %Y, %H:%M')
+
+
+# Column layout, keys are listed once in the header instead of on every row
+def to_columnar(rows: list[dict], max_bytes: int | None = None, omitted: int | None = 0) -> str:
+    # Rows beyond max_bytes are dropped from the end and reported in a marker line,
+    # omitted counts rows the caller already dropped, None if their number is unknown
+    columns = list(rows[0]) if rows else []
+    lines = [' | '.join(columns)]
+    if max_bytes is not None:
+        max_bytes -= len(lines[0].encode('utf-8')) + _omitted_line_reserve
+    for index, row in enumerate(rows):
+        line = _columnar_line(row.get(column, '') for column in columns)
+        if max_bytes is not None:
+            max_bytes -= len(line.encode('utf-8')) + 1
+            if max_bytes < 0:
+                omitted = None if omitted is None else omitted + len(rows) - index
+                break
+        lines.append(line)
+    if omitted != 0:
+        lines.append(_omitted_line(omitted))
+    return '\n'.join(lines)
+
+
+def _columnar_line(cells) -> str:
+    return ' | '.join(_columnar_cell(cell) for cell in cells)
+
+
+def _columnar_cell(value) -> str:
+    if not isinstance(value, str):
+        value = msgspec.json.encode(value).decode()
+    return value.replace('\n', ' ').replace('|', '/')
+
+
+def _omitted_line(omitted: int | None) -> str:
+    if omitted is None:
+        return "... more rows omitted"
+    return f"... {omitted} more rows omitted"
+
+
+# Space kept free for the marker line, including its newline
+_omitted_line_reserve = len(('\n' + _omitted_line(10 ** 9)).encode('utf-8'))
+
+
+def _fit_response(prefix: str, rows: list[dict], omitted: int | None = 0) -> str:
+    return prefix + to_columnar(rows, MAX_RESPONSE_LENGTH - len(prefix.encode('utf-8')), omitted)
+
+
+# Typed history response, decoded and validated in one pass
+class HistoryPoint(msgspec.Struct):
+    clock: int
+    value: str
+
+
+class HistoryResponse(msgspec.Struct):
+    result: list[HistoryPoint] = []
+    error: dict | None = None
+
+
+def _decode(content: bytes, content_type: str, response_type: type | None = None):
+    if cbor2 is not None and content_type.startswith('application/cbor'):
+        response = cbor2.loads(content)
+        if response_type is not None:
+            return msgspec.convert(response, response_type, strict=False)
+        return response
+    if response_type is not None:
+        return msgspec.json.decode(content, type=response_type, strict=False)
+    return msgspec.json.decode(content)
+
+
+async def _post(payload: bytes):
+    session = await _get_session()
+    async with session.post(ZABBIX_API_URL, headers=headers_dict, data=payload) as response:
+        return _decode(await response.read(), response.headers.get('Content-Type', ''))
+
+
+def _history_row(clock: int, value: str) -> dict:
+    return {'clock': _format_minute(clock // 60), 'value': value}
+
+
+async def _stream_history_rows(stream) -> tuple[list[dict], int | None, dict | None]:
+    # Parse points as they arrive and stop reading once the response budget is spent,
+    # the number of skipped rows is unknown then
+    max_bytes = (MAX_RESPONSE_LENGTH - len(history_prefix.encode('utf-8'))
+                 - len(history_header.encode('utf-8')) - _omitted_line_reserve)
+    rows, point, error = [], {}, {}
+    async for prefix, event, value in ijson.parse_async(stream):
+        if prefix in ('result.item.clock', 'result.item.value'):
+            point[prefix.rsplit('.', 1)[1]] = value
+        elif prefix == 'result.item' and event == 'end_map':
+            row = _history_row(int(point['clock']), str(point['value']))
+            max_bytes -= len(_columnar_line(row.values()).encode('utf-8')) + 1
+            if max_bytes < 0:
+                return rows, None, error or None
+            rows.append(row)
+            point = {}
+        elif prefix.startswith('error.'):
+            error[prefix.split('.', 1)[1]] = value
+    return rows, 0, error or None
+
+
+async def _post_history(payload: bytes) -> tuple[list[dict], int | None, dict | None]:
+    session = await _get_session()
+    async with session.post(ZABBIX_API_URL, headers=headers_dict, data=payload) as response:
+        content_type = response.headers.get('Content-Type', '')
+        # A compressed length says nothing about the decoded size, so compressed bodies are always streamed
+        compressed = response.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+        small = not compressed and response.content_length is not None and response.content_length <= history_stream_threshold
+        if content_type.startswith('application/cbor') or small:
+            history = _decode(await response.read(), content_type, HistoryResponse)
+            return [_history_row(point.clock, point.value) for point in history.result], 0, history.error
+        return await _stream_history_rows(response.content)
+
+
+def _api_error(error: dict) -> str:
+    if not isinstance(error, dict):
+        return "Zabbix API error: " + str(error)
+    message = "Zabbix API error: " + error.get('message', 'unknown')
+    if error.get('data'):
+        message += " " + str(error['data'])
+    return message
+
+
+def _is_unexpected(response) -> bool:
+    # Zabbix answers with an object holding either a list of result objects or an error
+    if not isinstance(response, dict):
+        return True
+    result = response.get('result', [])
+    return not isinstance(result, list) or not all(isinstance(row, dict) for row in result)
+
+
+def _is_not_found(key: tuple) -> bool:
+    with _cache_lock:
+        not_found = _not_found_cache.get(key) is NOT_FOUND
+    _count_cache('cache_hits' if not_found else 'cache_misses')
+    return not_found
+
+
+def _set_not_found(key: tuple) -> None:
+    with _cache_lock:
+        _not_found_cache[key] = NOT_FOUND
+
+
+def _count_cache(counter: str) -> None:
+    call_metrics = _call_metrics.get()
+    if call_metrics is not None:
+        call_metrics[counter] += 1
+
+
+def _metered(function):
+    # Record latency, response length and cache use of a tool call
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        call_metrics = {'cache_hits': 0, 'cache_misses': 0}
+        token = _call_metrics.set(call_metrics)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = await function(*args, **kwargs)
+        finally:
+            _call_metrics.reset(token)
+            _record_metrics(function.__name__, time.perf_counter() - start, result, call_metrics)
+        return result
+
+    return wrapper
+
+
+def _record_metrics(name: str, elapsed: float, result: str | None, call_metrics: dict) -> None:
+    # A call that raised has no result and is counted as a failure
+    with _metrics_lock:
+        metrics = _tool_metrics[name]
+        metrics['calls'] += 1
+        metrics['seconds'] += elapsed
+        if result is None:
+            metrics['failures'] += 1
+        else:
+            metrics['characters'] += len(result)
+        metrics['cache_hits'] += call_metrics['cache_hits']
+        metrics['cache_misses'] += call_metrics['cache_misses']
+    if result is None:
+        logger.debug('%s failed after %.3f s, cache hits %d, misses %d', name, elapsed,
+                     call_metrics['cache_hits'], call_metrics['cache_misses'])
+    else:
+        logger.debug('%s took %.3f s, returned %d characters, cache hits %d, misses %d', name, elapsed,
+                     len(result), call_metrics['cache_hits'], call_metrics['cache_misses'])
+
+
+def get_metrics() -> dict:
+    # Snapshot of the per tool metrics, including the cache hit rate
+    with _metrics_lock:
+        snapshot = {name: dict(metrics) for name, metrics in _tool_metrics.items()}
+    for metrics in snapshot.values():
+        lookups = metrics['cache_hits'] + metrics['cache_misses']
+        metrics['cache_hit_rate'] = metrics['cache_hits'] / lookups if lookups else None
+    return snapshot
+
+
+async def _cached_post(payload: bytes) -> dict:
+    with _cache_lock:
+        response = _cache.get(payload)
+        if response is not None:
+            _count_cache('cache_hits')
+            return response
+        _count_cache('cache_misses')
+
+    response = await _post(payload)
+    if not _is_unexpected(response) and 'result' in response:
+        with _cache_lock:
+            _cache[payload] = response
+    return response
 
 
 @tool(parse_docstring=True)
-def zabbix_host_list() -> str:
+@_metered
+async def zabbix_host_list(limit: int = result_limit) -> str:
     """
     This tool lets you retrieve a list of hosts monitored by Zabbix.
     You can use it as a starting point for further exploration.
 
     Host is a device, such as desktop or a VM.
 
+    Args:
+        limit: Maximum number of returned hosts.
+
     Returns:
         str: List of host ids, names and statuses.
     """
 
-    body_dict = {
-        'jsonrpc': '2.0',
-        'method': 'host.get',
-        'params': {
+    if limit == result_limit:
+        payload = _host_list_body
+    else:
+        payload = msgspec.json.encode(_request_body('host.get', {
             'output': ['host', 'status'],
-        },
-        'id': 1,
-        'auth': os.getenv('ZABBIX_API_TOKEN')
-    }
-    body_json = json.dumps(body_dict)
+            'limit': limit,
+        }))
 
     try:
-        response = requests.post(os.getenv('ZABBIX_API_URL'), headers=headers_dict, data=body_json)
-        result = response.json()['result']
-        return "Here is the requested list of hosts: " + str(result)
+        response = await _cached_post(payload)
     except Exception as error:
         return "Error occurred while retrieving the list of hosts: " + str(error)
 
+    if _is_unexpected(response):
+        return "Error occurred while retrieving the list of hosts: unexpected response"
+    if 'error' in response:
+        return _api_error(response['error'])
+    result = response.get('result', [])
+    return _fit_response("Here is the requested list of hosts:\n", result)
+
 
 @tool(parse_docstring=True)
-def zabbix_item_list(host_name: str) -> str:
+@_metered
+async def zabbix_item_list(host_name: str, limit: int = result_limit) -> str:
     """
     It is advised to retrieve the list of hosts before using this tool!
 
@@ -55,33 +409,34 @@ def zabbix_item_list(host_name: str) -> str:
 
     Args:
         host_name: Must be a value from the retrieved host list.
+        limit: Maximum number of returned items.
 
     Returns:
         str: List of item ids, names and descriptions.
     """
 
-    body_dict = {
-        'jsonrpc': '2.0',
-        'method': 'item.get',
-        'params': {
-            'host': host_name,
-            'output': ['name', 'description'],
-        },
-        'id': 1,
-        'auth': os.getenv('ZABBIX_API_TOKEN')
-    }
-    body_json = json.dumps(body_dict)
+    payload = msgspec.json.encode(_request_body('item.get', {
+        'host': host_name,
+        'output': ['name', 'description'],
+        'limit': limit,
+    }))
 
     try:
-        response = requests.post(os.getenv('ZABBIX_API_URL'), headers=headers_dict, data=body_json)
-        result = response.json()['result']
-        return "Here is the requested list of items: " + str(result)
+        response = await _cached_post(payload)
     except Exception as error:
         return "Error occurred while retrieving the list of items: " + str(error)
 
+    if _is_unexpected(response):
+        return "Error occurred while retrieving the list of items: unexpected response"
+    if 'error' in response:
+        return _api_error(response['error'])
+    result = response.get('result', [])
+    return _fit_response("Here is the requested list of items:\n", result)
+
 
 @tool(parse_docstring=True)
-def zabbix_item_value(host_name: str, item_name: str) -> str:
+@_metered
+async def zabbix_item_value(host_name: str, item_name: str) -> str:
     """
     It is advised to retrieve the list of hosts and items before using this tool!
 
@@ -99,34 +454,39 @@ def zabbix_item_value(host_name: str, item_name: str) -> str:
         str: Item id, name, value and units.
     """
 
-    body_dict = {
-        'jsonrpc': '2.0',
-        'method': 'item.get',
-        'params': {
-            'host': host_name,
-            'search': {
-                'name': item_name,
-            },
-            'output': ['name', 'lastvalue', 'units'],
+    not_found_key = ('item.get', host_name, item_name)
+    if _is_not_found(not_found_key):
+        return not_monitored_message
+
+    payload = msgspec.json.encode(_request_body('item.get', {
+        'host': host_name,
+        'search': {
+            'name': item_name,
         },
-        'id': 1,
-        'auth': os.getenv('ZABBIX_API_TOKEN')
-    }
-    body_json = json.dumps(body_dict)
+        'output': ['name', 'lastvalue', 'units'],
+        'limit': result_limit,
+    }))
 
     try:
-        response = requests.post(os.getenv('ZABBIX_API_URL'), headers=headers_dict, data=body_json)
-        result = response.json()['result']
-        if result:
-            return "Here is the requested item value: " + str(result)
-        else:
-            return "The requested item is not monitored on the selected host."
+        response = await _post(payload)
     except Exception as error:
         return "Error occurred while retrieving the item value: " + str(error)
 
+    if _is_unexpected(response):
+        return "Error occurred while retrieving the item value: unexpected response"
+    if 'error' in response:
+        return _api_error(response['error'])
+    result = response.get('result', [])
+    if result:
+        return _fit_response("Here is the requested item value:\n", result)
+    else:
+        _set_not_found(not_found_key)
+        return not_monitored_message
+
 
 @tool(parse_docstring=True)
-def zabbix_item_history(host_name: str, item_name: str) -> str:
+@_metered
+async def zabbix_item_history(host_name: str, item_name: str) -> str:
     """
     It is advised to retrieve the list of hosts and items before using this tool!
 
@@ -141,58 +501,85 @@ def zabbix_item_history(host_name: str, item_name: str) -> str:
         item_name: Must be a value from the retrieved item list.
 
     Returns:
-        str: Item ids, times and values.
+        str: Item times and values.
     """
 
-    body_dict = {
-        'jsonrpc': '2.0',
-        'method': 'item.get',
-        'params': {
+    item_key = (host_name, item_name)
+    not_found_key = ('history.get', host_name, item_name)
+    if _is_not_found(not_found_key):
+        return not_monitored_message
+
+    with _cache_lock:
+        item = _item_lookup_cache.get(item_key)
+    _count_cache('cache_hits' if item is not None else 'cache_misses')
+
+    if item is None:
+        payload = msgspec.json.encode(_request_body('item.get', {
             'host': host_name,
             'search': {
                 'name': item_name,
             },
-            'output': ['name', 'type', 'lastvalue', 'units'],
-        },
-        'id': 1,
-        'auth': os.getenv('ZABBIX_API_TOKEN')
-    }
-    body_json = json.dumps(body_dict)
-
-    try:
-        response = requests.post(os.getenv('ZABBIX_API_URL'), headers=headers_dict, data=body_json)
-        item_result = response.json()['result']
-        print(item_result)
+            'output': ['itemid', 'type', 'lastvalue'],
+            'limit': 1,
+        }))
+
+        try:
+            response = await _post(payload)
+        except Exception as error:
+            return "Error occurred while retrieving the item history: " + str(error)
+
+        if _is_unexpected(response):
+            return "Error occurred while retrieving the item history: unexpected response"
+        if 'error' in response:
+            return _api_error(response['error'])
+        item_result = response.get('result', [])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Item lookup result: %s', item_result)
         if not item_result:
-            return "The requested item is not monitored on the selected host."
+            _set_not_found(not_found_key)
+            return not_monitored_message
 
+        first = item_result[0]
+        if first.get('itemid') is None:
+            return "Error occurred while retrieving the item history: unexpected response"
+        item = {'itemid': first['itemid'], 'type': first.get('type')}
         # Set type to int
-        if item_result[0]['lastvalue'].isdigit():
-            item_result[0]['type'] = 3
-
-        body_dict = {
-            'jsonrpc': '2.0',
-            'method': 'history.get',
-            'params': {
-                'itemids': item_result[0]['itemid'],
-                'history': item_result[0]['type'],
-                'time_from': int(datetime.now().timestamp()) - 3600,
-                'output': ['clock', 'value'],
-            },
-            'id': 1,
-            'auth': os.getenv('ZABBIX_API_TOKEN')
-        }
-        body_json = json.dumps(body_dict)
-
-        response = requests.post(os.getenv('ZABBIX_API_URL'), headers=headers_dict, data=body_json)
-        print(response.json())
-        history_result = response.json()['result']
-        for item_value in history_result:
-            item_value['clock'] = datetime.fromtimestamp(int(item_value['clock'])).strftime('%d. %B %Y, %H:%M')
-
-        if history_result:
-            return "Here is the requested item history: " + str(history_result)
-        else:
-            return "The requested item is not monitored on the selected host."
+        if str(first.get('lastvalue') or '').isdigit():
+            item['type'] = 3
+        with _cache_lock:
+            _item_lookup_cache[item_key] = item
+
+    payload = msgspec.json.encode(_request_body('history.get', {
+        'itemids': item['itemid'],
+        'history': item['type'],
+        'time_from': int(datetime.now().timestamp()) - 3600,
+        'output': ['clock', 'value'],
+        'sortfield': 'clock',
+        'sortorder': 'DESC',
+    }))
+
+    try:
+        history_result, history_omitted, history_error = await _post_history(payload)
     except Exception as error:
         return "Error occurred while retrieving the item history: " + str(error)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('History rows: %s', history_result)
+    if history_error is not None:
+        return _api_error(history_error)
+
+    if history_result or history_omitted != 0:
+        return _fit_response(history_prefix, history_result, history_omitted)
+    else:
+        _set_not_found(not_found_key)
+        return not_monitored_message
+
+
+# Tools are built once at import, callers share the same instances and schemas
+TOOLS = (zabbix_host_list, zabbix_item_list, zabbix_item_value, zabbix_item_history)
+for _tool in TOOLS:
+    _tool.func = _sync_function(_tool.coroutine)
+
+
+def get_tools() -> list:
+    return list(TOOLS)
@@ -4,39 +4,206 @@ author: Tjaš Ajdovec
 description: This tool lets the LLM interact with the Zabbix server, which is used for centralized device monitoring.
 git_url: https://github.com/ta5946
 version: 1.0.1
+requirements: cachetools, orjson
 """
 
 # TODO Multiple tool calls in one prompt not available in Open WebUI version 5.0.3
 # TODO Define more Zabbix API methods from https://www.zabbix.com/documentation/current/en/manual/api/reference
 
+import time
+import asyncio
+import logging
+import functools
+import orjson
 import requests
-import json
+from threading import Lock
+from collections import defaultdict
+from contextvars import ContextVar
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pydantic import BaseModel, Field
 
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
-# Generic request function
-def api_request(url, headers, body):
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+PROMPT_PREFIX = 'Describe the Zabbix API response you received to the user who requested it: '
+
+# Shared HTTP session, keeps connections alive between requests
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.2))
+_SESSION.mount('http://', _ADAPTER)
+_SESSION.mount('https://', _ADAPTER)
+
+# Cache for slowly changing list responses
+_cache = TTLCache(maxsize=256, ttl=60)
+_cache_lock = Lock()
+
+# Per tool metrics, cache counters of a call are collected in a context variable
+_tool_metrics = defaultdict(lambda: {'calls': 0, 'failures': 0, 'seconds': 0.0, 'characters': 0, 'cache_hits': 0, 'cache_misses': 0})
+_metrics_lock = Lock()
+_call_metrics = ContextVar('call_metrics', default=None)
+
+
+# Decode CBOR if the server negotiated it, JSON otherwise
+def decode_response(content, content_type):
+    if cbor2 is not None and content_type.startswith('application/cbor'):
+        return cbor2.loads(content)
+    return orjson.loads(content)
+
+
+def count_cache(counter):
+    call_metrics = _call_metrics.get()
+    if call_metrics is not None:
+        call_metrics[counter] += 1
+
+
+# Record latency, response length and cache use of a tool method
+def metered(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        call_metrics = {'cache_hits': 0, 'cache_misses': 0}
+        token = _call_metrics.set(call_metrics)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = await function(*args, **kwargs)
+        finally:
+            _call_metrics.reset(token)
+            _record_metrics(function.__name__, time.perf_counter() - start, result, call_metrics)
+        return result
+
+    return wrapper
+
+
+# A call that raised has no result and is counted as a failure
+def _record_metrics(name, elapsed, result, call_metrics):
+    with _metrics_lock:
+        metrics = _tool_metrics[name]
+        metrics['calls'] += 1
+        metrics['seconds'] += elapsed
+        if result is None:
+            metrics['failures'] += 1
+        else:
+            metrics['characters'] += len(result)
+        metrics['cache_hits'] += call_metrics['cache_hits']
+        metrics['cache_misses'] += call_metrics['cache_misses']
+    if result is None:
+        logger.debug('%s failed after %.3f s, cache hits %d, misses %d', name, elapsed,
+                     call_metrics['cache_hits'], call_metrics['cache_misses'])
+    else:
+        logger.debug('%s took %.3f s, returned %d characters, cache hits %d, misses %d', name, elapsed,
+                     len(result), call_metrics['cache_hits'], call_metrics['cache_misses'])
+
+
+# Snapshot of the per tool metrics, including the cache hit rate
+def get_metrics():
+    with _metrics_lock:
+        snapshot = {name: dict(metrics) for name, metrics in _tool_metrics.items()}
+    for metrics in snapshot.values():
+        lookups = metrics['cache_hits'] + metrics['cache_misses']
+        metrics['cache_hit_rate'] = metrics['cache_hits'] / lookups if lookups else None
+    return snapshot
+
+
+# Generic request function, body can be passed already serialized
+def api_request(url, headers, body, session=None):
+    session = session or _SESSION
+    payload = body if isinstance(body, bytes) else orjson.dumps(body)
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(body))
-        return response.json(), False
+        response = session.post(url, headers=headers, data=payload, timeout=(3, 10))
+        data = decode_response(response.content, response.headers.get('Content-Type', ''))
     except Exception as error:
         return {'Exception': str(error)}, True
 
+    # Zabbix reports API errors in the response body, anything but an object is unexpected
+    return data, not isinstance(data, dict) or 'error' in data
+
+
+# Cached request function for list endpoints
+def cached_api_request(url, headers, body, session=None):
+    payload = orjson.dumps(body)
+    key = (url, headers.get('Authorization'), payload)
+    with _cache_lock:
+        response = _cache.get(key)
+        if response is not None:
+            count_cache('cache_hits')
+            return response, False
+        count_cache('cache_misses')
+
+    response, error = api_request(url, headers, payload, session)
+    if not error and 'result' in response:
+        with _cache_lock:
+            _cache[key] = response
+    return response, error
+
+
+# Async wrappers, run the blocking request in a worker thread
+async def async_api_request(url, headers, body, session=None):
+    return await asyncio.to_thread(api_request, url, headers, body, session)
+
+
+async def async_cached_api_request(url, headers, body, session=None):
+    return await asyncio.to_thread(cached_api_request, url, headers, body, session)
+
 
-def validate_prompt(prompt, max_length):
-    if len(prompt) > max_length:
-        print('Truncating response.')
-        return prompt[:max_length]
+# Column layout, keys are listed once in the header instead of on every row
+def to_columnar(rows):
+    columns = list(rows[0]) if rows else []
+    lines = [' | '.join(columns)]
+    for row in rows:
+        cells = (row.get(column, '') for column in columns)
+        lines.append(' | '.join(_columnar_cell(cell) for cell in cells))
+    return '\n'.join(lines)
+
+
+def _columnar_cell(value):
+    if not isinstance(value, str):
+        value = orjson.dumps(value).decode()
+    return value.replace('\n', ' ').replace('|', '/')
+
+
+# Result limit, roughly one object per 80 characters of the response
+def result_limit(max_response_length):
+    return max(1, max_response_length // 80)
+
+
+# Serialize the response and fit it into the prompt size limit
+def validate_prompt(response, max_length):
+    result = response.get('result') if isinstance(response, dict) else None
+    if result and isinstance(result, list) and all(isinstance(row, dict) for row in result):
+        data = to_columnar(result).encode('utf-8')
     else:
-        print('Valid response.')
-        return prompt
+        data = orjson.dumps(response)
+    max_bytes = max_length - len(PROMPT_PREFIX.encode('utf-8'))
+    if len(data) > max_bytes:
+        logger.debug('Truncating response.')
+        return PROMPT_PREFIX + data[:max(max_bytes, 0)].decode('utf-8', errors='ignore')
+    else:
+        logger.debug('Valid response.')
+        return PROMPT_PREFIX + data.decode('utf-8')
 
 
 # Tool class
 class Tools:
     def __init__(self):
         self.valves = self.Valves()
-        self.headers = {'Content-Type': 'application/json'}
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip, br' if brotli is not None else 'gzip',
+        }
+        if cbor2 is not None:
+            self.headers['Accept'] = 'application/cbor, application/json;q=0.9'
         self.citation = True
         
     # Auth headers
@@ -68,6 +235,7 @@ class Tools:
         )
 
     # Host list request
+    @metered
     async def get_host_list(self, __event_emitter__) -> str:
         """
         This function lets you retrieve the list of hosts monitored by Zabbix.
@@ -79,10 +247,18 @@ class Tools:
             'method': 'host.get',
             'params': {
                 'output': ['host', 'status'],
+                'limit': result_limit(self.valves.max_response_length),
             },
             'id': 1,
         }
-        response, error = api_request(self.valves.zabbix_api_url, self._auth_headers(), body)
+        headers = self._auth_headers()
+        await __event_emitter__(
+            {
+                'type': 'status',
+                'data': {'description': 'Retrieving host list.', 'done': False},
+            }
+        )
+        response, error = await async_cached_api_request(self.valves.zabbix_api_url, headers, body)
 
         if error:
             status = 'Error retrieving host list.'
@@ -95,10 +271,11 @@ class Tools:
             }
         )
 
-        prompt = validate_prompt(f"""Describe the Zabbix API response you received to the user who requested it: {response}""", self.valves.max_response_length)
+        prompt = validate_prompt(response, self.valves.max_response_length)
         return prompt
 
     # Problem list request
+    @metered
     async def get_problem_list(self, __event_emitter__) -> str:
         """
         This function lets you retrieve the list of current problems detected by Zabbix.
@@ -110,10 +287,18 @@ class Tools:
             'method': 'problem.get',
             'params': {
                 'output': ['name'],
+                'limit': result_limit(self.valves.max_response_length),
             },
             'id': 1,
         }
-        response, error = api_request(self.valves.zabbix_api_url, self._auth_headers(), body)
+        headers = self._auth_headers()
+        await __event_emitter__(
+            {
+                'type': 'status',
+                'data': {'description': 'Retrieving problem list.', 'done': False},
+            }
+        )
+        response, error = await async_cached_api_request(self.valves.zabbix_api_url, headers, body)
 
         if error:
             status = 'Error retrieving problem list.'
@@ -126,10 +311,11 @@ class Tools:
             }
         )
 
-        prompt = validate_prompt(f"""Describe the Zabbix API response you received to the user who requested it: {response}""", self.valves.max_response_length)
+        prompt = validate_prompt(response, self.valves.max_response_length)
         return prompt
 
     # Item list request
+    @metered
     async def get_item_list(self, host_name: str, __event_emitter__) -> str:
         """
         This function lets you retrieve the list of available items for a specified host monitored by Zabbix.
@@ -144,10 +330,18 @@ class Tools:
             'params': {
                 'host': host_name,
                 'output': ['name'],
+                'limit': result_limit(self.valves.max_response_length),
             },
             'id': 1,
         }
-        response, error = api_request(self.valves.zabbix_api_url, self._auth_headers(), body)
+        headers = self._auth_headers()
+        await __event_emitter__(
+            {
+                'type': 'status',
+                'data': {'description': 'Retrieving item list.', 'done': False},
+            }
+        )
+        response, error = await async_cached_api_request(self.valves.zabbix_api_url, headers, body)
 
         if error:
             status = 'Error retrieving item list.'
@@ -160,10 +354,11 @@ class Tools:
             }
         )
 
-        prompt = validate_prompt(f"""Describe the Zabbix API response you received to the user who requested it: {response}""", self.valves.max_response_length)
+        prompt = validate_prompt(response, self.valves.max_response_length)
         return prompt
 
     # Item value request
+    @metered
     async def get_item_value(self, host_name: str, item_name: str, __event_emitter__) -> str:
         """
         This function lets you retrieve the item value for a specific host monitored by Zabbix.
@@ -182,10 +377,18 @@ class Tools:
                     "name": item_name,
                 },
                 'output': ['name', 'lastvalue', 'units'],
+                'limit': result_limit(self.valves.max_response_length),
             },
             'id': 1,
         }
-        response, error = api_request(self.valves.zabbix_api_url, self._auth_headers(), body)
+        headers = self._auth_headers()
+        await __event_emitter__(
+            {
+                'type': 'status',
+                'data': {'description': 'Retrieving item value.', 'done': False},
+            }
+        )
+        response, error = await async_api_request(self.valves.zabbix_api_url, headers, body)
 
         if error:
             status = 'Error retrieving item value.'
@@ -198,5 +401,5 @@ class Tools:
             }
         )
 
-        prompt = validate_prompt(f"""Describe the Zabbix API response you received to the user who requested it: {response}""", self.valves.max_response_length)
+        prompt = validate_prompt(response, self.valves.max_response_length)
         return prompt